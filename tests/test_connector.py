@@ -1,5 +1,12 @@
 import unittest2 as unittest
-from os.path import join, expanduser
+import json
+import shutil
+import tempfile
+import threading
+import time
+from os import listdir, makedirs
+from os.path import join, expanduser, isdir
+from unittest import mock
 from xnatconnect.XnatConnector import XnatConnector
 
 
@@ -44,5 +51,217 @@ class TestConnector(unittest.TestCase):
         self.assertEqual(sid, subjectid, "Subject id is not equal")
 
 
+class StubInterface:
+    '''Returns fixed rows in place of XNAT REST listings'''
+    def __init__(self, rows):
+        self.rows = rows
+
+    def _get_json(self, uri):
+        return self.rows
+
+
+class StubSubject:
+    def __init__(self, sid='XNAT_S00001', projectcode='TEST'):
+        self._uri = '/data/projects/%s/subjects/%s' % (projectcode, sid)
+
+
+class StubProject:
+    def __init__(self, projectcode):
+        self.projectcode = projectcode
+
+    def subject(self, sid):
+        return StubSubject(sid, self.projectcode)
+
+
+class StubUploadInterface:
+    '''
+    Project subject listing and MR sessions created by StubScanUploader, recording the URIs requested
+    '''
+    def __init__(self, subjects, delay=0.0):
+        self.subjects = subjects  # label -> ID
+        self.sessions = {}  # subject uri -> session labels
+        self.uris = []
+        self.delay = delay  # network latency for session listing
+
+    def select(self, qry):
+        return StubProject(qry.rsplit('/', 1)[1])
+
+    def _get_json(self, uri):
+        self.uris.append(uri)
+        if '/experiments' in uri:
+            suri = uri.split('/experiments', 1)[0]
+            time.sleep(self.delay)
+            return [{'label': l, 'xsiType': 'xnat:mrSessionData'} for l in self.sessions.get(suri, [])]
+        return [{'label': l, 'ID': sid} for l, sid in self.subjects.items()]
+
+
+class StubScanUploader:
+    '''
+    Records uploads and creates the session in the stub interface - one scan per upload
+    '''
+    def __init__(self, conn, delay=0.0):
+        self.conn = conn
+        self.delay = delay
+        self.uploads = []  # (subject uri, uploaddir, session label)
+        self.active = {}  # subject uri -> concurrent uploads
+        self.max_active = {}
+        self.lock = threading.Lock()
+
+    def subject_uploadscans(self, xnatsubject, uploaddir, exptlabel, visitid=None):
+        suri = xnatsubject._uri
+        with self.lock:
+            self.active[suri] = self.active.get(suri, 0) + 1
+            self.max_active[suri] = max(self.max_active.get(suri, 0), self.active[suri])
+            self.conn.sessions.setdefault(suri, []).append(exptlabel)
+            self.uploads.append((suri, uploaddir, exptlabel))
+        time.sleep(self.delay)
+        with self.lock:
+            self.active[suri] -= 1
+        return 1
+
+
+class StubConfigTestCase(unittest.TestCase):
+    '''
+    No XNAT instance required - XnatConnector from a temporary config, conn to be stubbed by tests
+    '''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        configfile = join(self.tmpdir, 'xnat.cfg')
+        with open(configfile, 'w') as f:
+            f.write('[stub]\nURL=https://localhost\nUSER=user\nPASS=pass\n')
+        self.xnat = XnatConnector(configfile, 'stub')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestCheckUniqueLabel(StubConfigTestCase):
+    '''
+    Experiment listing is stubbed
+    '''
+    def setExperiments(self, labels, xsitype='xnat:mrSessionData'):
+        self.xnat.conn = StubInterface([{'label': l, 'xsiType': xsitype} for l in labels])
+
+    def test_unused_label(self):
+        self.setExperiments(['MR_S0001_0'])
+        self.assertEqual('MR_S0001_1', self.xnat.checkUniqueLabel(StubSubject(), 'MR_S0001_1'))
+
+    def test_next_after_existing(self):
+        self.setExperiments(['MR_S0001_0', 'MR_S0001_1'])
+        self.assertEqual('MR_S0001_2', self.xnat.checkUniqueLabel(StubSubject(), 'MR_S0001_0'))
+
+    def test_numeric_not_string_order(self):
+        self.setExperiments(['MR_S0001_%d' % i for i in range(11)])
+        self.assertEqual('MR_S0001_11', self.xnat.checkUniqueLabel(StubSubject(), 'MR_S0001_0'))
+
+    def test_other_prefix_ignored(self):
+        self.setExperiments(['MR_S0001_0', 'MR_S00010_5'])
+        self.assertEqual('MR_S0001_1', self.xnat.checkUniqueLabel(StubSubject(), 'MR_S0001_0'))
+
+    def test_other_datatype_ignored(self):
+        self.setExperiments(['MR_S0001_0'], xsitype='xnat:petSessionData')
+        self.assertEqual('MR_S0001_0', self.xnat.checkUniqueLabel(StubSubject(), 'MR_S0001_0'))
+
+
+class TestUploadState(StubConfigTestCase):
+    '''
+    State file in a temporary directory
+    '''
+    def setUp(self):
+        super(TestUploadState, self).setUp()
+        self.statefile = join(self.tmpdir, 'upload_state.json')
+
+    def test_missing_file(self):
+        self.assertEqual({}, self.xnat._load_upload_state(self.statefile))
+
+    def test_save_and_load(self):
+        state = {'1001DS': '2017-06-01T10:00:00', 'S0001': '2017-06-02T11:30:00'}
+        self.xnat._save_upload_state(self.statefile, state)
+        self.assertEqual(state, self.xnat._load_upload_state(self.statefile))
+
+    def test_corrupt_file(self):
+        with open(self.statefile, 'w') as f:
+            f.write('{not json')
+        self.assertEqual({}, self.xnat._load_upload_state(self.statefile), 'Corrupt state not ignored')
+
+
+class TestUploadMRIscans(StubConfigTestCase):
+    '''
+    Subject dirs in a temporary scandir - XNAT interface and ScanUploader are stubbed
+    '''
+    def setUp(self):
+        super(TestUploadMRIscans, self).setUp()
+        self.scandir = join(self.tmpdir, 'MRI_3m')
+        self.xnat.conn = StubUploadInterface({'S0001': 'XNAT_S00001', 'S0002': 'XNAT_S00002'})
+        self.uploader = StubScanUploader(self.xnat.conn)
+
+    def makeSubjectDirs(self, *slabels):
+        for slabel in slabels:
+            makedirs(join(self.scandir, slabel, 'scans'))
+
+    def donepath(self, projectcode='P1'):
+        return join(self.tmpdir, 'done', projectcode, 'MRI_3m')
+
+    def upload(self, projectcode='P1', **kwargs):
+        with mock.patch('xnatconnect.XnatConnector.ScanUploader', lambda proj_pi: self.uploader):
+            return self.xnat.upload_MRIscans(projectcode, self.scandir, **kwargs)
+
+    def setState(self, state, projectcode='P1'):
+        makedirs(self.donepath(projectcode))
+        with open(join(self.donepath(projectcode), 'upload_state.json'), 'w') as f:
+            json.dump(state, f)
+
+    def uploadedDirs(self):
+        return sorted(u[1] for u in self.uploader.uploads)
+
+    def test_done_layout_and_state(self):
+        self.makeSubjectDirs('S0001', 'S0002')
+        self.assertEqual(2, self.upload())
+        donepath = self.donepath()
+        self.assertTrue(isdir(join(donepath, 'S0001')) and isdir(join(donepath, 'S0002')), 'Dirs not moved to done')
+        self.assertEqual([], listdir(self.scandir))
+        with open(join(donepath, 'upload_state.json')) as f:
+            self.assertEqual(['S0001', 'S0002'], sorted(json.load(f)))
+
+    def test_skip_recorded_without_rest(self):
+        self.makeSubjectDirs('S0001', 'S0002')
+        self.setState({'S0001': '2017-06-01T10:00:00'})
+        makedirs(join(self.donepath(), 'S0002'))
+        self.assertEqual(0, self.upload())
+        self.assertEqual([], self.uploader.uploads)
+        self.assertEqual([], self.xnat.conn.uris, 'REST called for skipped subjects')
+        self.assertEqual(['S0001', 'S0002'], sorted(listdir(self.scandir)))
+
+    def test_skip_recorded_uploads_others(self):
+        self.makeSubjectDirs('S0001', 'S0002')
+        self.setState({'S0001': '2017-06-01T10:00:00'})
+        self.assertEqual(1, self.upload())
+        self.assertEqual([join(self.scandir, 'S0002', 'scans')], self.uploadedDirs())
+
+    def test_force(self):
+        self.makeSubjectDirs('S0001')
+        self.setState({'S0001': '2017-06-01T10:00:00'})
+        self.assertEqual(1, self.upload(force=True))
+        self.assertEqual([join(self.scandir, 'S0001', 'scans')], self.uploadedDirs())
+
+    def test_other_project_not_skipped(self):
+        self.makeSubjectDirs('S0001')
+        self.setState({'S0001': '2017-06-01T10:00:00'}, projectcode='P1')
+        self.assertEqual(1, self.upload(projectcode='P2'))
+        self.assertTrue(isdir(join(self.donepath('P2'), 'S0001')), 'Dir not moved to project done dir')
+
+    def test_same_subject_dirs_uploaded_in_series(self):
+        # opexid dirs 1006JJ06 and 1006JJ12 are both subject 1006JJ
+        self.xnat.conn.subjects = {'1006JJ': 'XNAT_S01006', '1007AB': 'XNAT_S01007'}
+        self.xnat.conn.delay = 0.05
+        self.uploader.delay = 0.05
+        self.makeSubjectDirs('1006JJ06', '1006JJ12', '1007AB06')
+        self.assertEqual(3, self.upload(opexid=True, max_workers=4))
+        suri = '/data/projects/P1/subjects/XNAT_S01006'
+        labels = sorted(u[2] for u in self.uploader.uploads if u[0] == suri)
+        self.assertEqual(['MR_1006JJ_0', 'MR_1006JJ_1'], labels, 'Session label reused')
+        self.assertEqual(1, self.uploader.max_active[suri], 'Same subject uploaded concurrently')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,8 @@
 import unittest2 as unittest
+import shutil
+import tempfile
 from os.path import join, expanduser, isdir, basename
-from os import listdir
+from os import listdir, mkdir
 from datetime import datetime
 from xnatconnect.XnatConnector import XnatConnector
 from xnatconnect.XnatUploadScans import ScanUploader
@@ -36,6 +38,14 @@ class TestScanUploader(unittest.TestCase):
         type = scanuploader.getScanType(scanuploader.default_scantype, self.dicomfile)
         self.assertEqual(type, scanuploader.default_scantype, "Scan type not default")
 
+    def test_read_dicom_header(self):
+        scanuploader = ScanUploader()
+        dcm = scanuploader._read_dicom_header(self.dicomfile)
+        self.assertIsNotNone(dcm, 'DICOM header not read')
+        self.assertIs(dcm, scanuploader._read_dicom_header(dcm), 'Parsed dataset not reused')
+        self.assertEqual(int(scanuploader.getSeriesNumber(self.seriesnum, dcm)), int(self.seriesnum),
+                         'Series number not matching')
+
     def test_getModality(self):
         scanuploader = ScanUploader()
         type = scanuploader.getModality(self.dicomfile)
@@ -67,5 +77,41 @@ class TestScanUploader(unittest.TestCase):
 
 
 
+class TestFirstDicomFile(unittest.TestCase):
+    '''
+    No DICOM files or XNAT instance required - uses a temporary series directory
+    '''
+    def setUp(self):
+        self.seriesdir = tempfile.mkdtemp()
+        self.scanuploader = ScanUploader()
+
+    def tearDown(self):
+        shutil.rmtree(self.seriesdir)
+
+    def touch(self, name):
+        open(join(self.seriesdir, name), 'w').close()
+
+    def test_empty_dir(self):
+        self.assertIsNone(self.scanuploader._first_dicom_file(self.seriesdir))
+
+    def test_dotfile_skipped(self):
+        self.touch('.DS_Store')
+        self.touch('.hidden.dcm')
+        self.assertIsNone(self.scanuploader._first_dicom_file(self.seriesdir), 'Hidden file returned')
+
+    def test_no_extension_skipped(self):
+        self.touch('DICOMDIR')
+        self.assertIsNone(self.scanuploader._first_dicom_file(self.seriesdir), 'File without extension returned')
+
+    def test_subdir_skipped(self):
+        mkdir(join(self.seriesdir, 'sub.dir'))
+        self.assertIsNone(self.scanuploader._first_dicom_file(self.seriesdir), 'Directory returned')
+
+    def test_dicom_found(self):
+        self.touch('.DS_Store')
+        self.touch('IM0001.dcm')
+        self.assertEqual(join(self.seriesdir, 'IM0001.dcm'), self.scanuploader._first_dicom_file(self.seriesdir))
+
+
 if __name__ == '__main__':
     unittest.main()
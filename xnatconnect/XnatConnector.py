@@ -10,22 +10,33 @@ import csv
 
 # import resource
 import datetime
+import json
 import logging
 import os
 import re
 import shutil
+import time
 import warnings
-from os import listdir
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import expanduser
 from os.path import join
 
 import pandas as pd
 import pyxnat
+import requests
+from requests.adapters import HTTPAdapter
 from configobj import ConfigObj
 
 from XnatUploadScans import ScanUploader
 
 warnings.filterwarnings("ignore")
+logger = logging.getLogger(__name__)
+
+# Default limit on concurrent subject uploads - also sets the HTTP connection pool size
+MAX_UPLOAD_WORKERS = 8
+# Record of uploaded subjects kept in the done directory
+UPLOAD_STATE_FILE = 'upload_state.json'
 
 class XnatConnector:
     def __init__(self, configfile, sitename):
@@ -33,14 +44,36 @@ class XnatConnector:
         self.url = config[sitename]['URL']
         self.user = config[sitename]['USER']
         self.passwd = config[sitename]['PASS']
+        self.conn = None
+        self._project_meta = {}  # (projectcode, columns) -> (timestamp, values)
         # print "Config:", self.url , ", ", self.user, ", ", self.passwd
 
     def connect(self):
         """
-        Connect to xnat server via config
+        Connect to xnat server via config - reuses existing connection
         """
+        if self.conn is not None:
+            return self.conn
         self.conn = pyxnat.Interface(server=self.url, user=self.user, verify=True,
-                                     password=self.passwd, cachedir='/tmp')  # connection object
+                                     password=self.passwd)  # connection object
+        # Keep-alive pool large enough for concurrent subject uploads
+        session = getattr(self.conn, '_http', None)
+        if isinstance(session, requests.Session):
+            adapter = HTTPAdapter(pool_maxsize=MAX_UPLOAD_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        else:
+            logger.debug("pyxnat session is not requests.Session - connection pool not mounted")
+        return self.conn
+
+    def _get_conn(self):
+        """
+        Get connection, connecting on first use
+        :return: pyxnat Interface
+        """
+        if self.conn is None:
+            self.connect()
+        return self.conn
 
     def testconnection(self):
         """
@@ -53,10 +86,26 @@ class XnatConnector:
         return (len(testconn) > 0)
 
     def get_project(self, projectcode):
-        if not self.conn:
-            self.connect()
         qry_project = '/projects/%s' % projectcode
-        return self.conn.select(qry_project)
+        return self._get_conn().select(qry_project)
+
+    def get_project_meta(self, projectcode, columns=('xnat:projectData/PI/lastname', 'xnat:projectData/name'),
+                         expiration=60):
+        """
+        Gets several project attributes in one request, cached for expiration seconds
+        :param projectcode:
+        :param columns: attribute paths
+        :param expiration: seconds before cached values are refetched
+        :return: dict of attribute path to value
+        """
+        key = (projectcode, tuple(columns))
+        cached = self._project_meta.get(key)
+        if cached is not None and time.time() - cached[0] < expiration:
+            return cached[1]
+        proj = self.get_project(projectcode)
+        meta = dict(zip(columns, proj.attrs.mget(list(columns))))
+        self._project_meta[key] = (time.time(), meta)
+        return meta
 
     def get_projectPI(self, projectcode):
         """
@@ -64,46 +113,36 @@ class XnatConnector:
         :param projectcode:
         :return:
         """
-        if not self.conn:
-            self.connect()
-        qry_project = '/projects/%s' % projectcode
-        proj = self.conn.select(qry_project)
-        return proj.attrs.get('xnat:projectData/PI/lastname')
+        return self.get_project_meta(projectcode).get('xnat:projectData/PI/lastname')
 
     def get_subjects(self, projectcode):
-        if not self.conn:
-            self.connect()
         qry = '/projects/%s/subjects' % projectcode
-        return self.conn.select(qry)
+        return self._get_conn().select(qry)
 
     def list_projects(self):
-        if not self.conn:
-            self.connect()
         qry_project = '/projects'
-        return self.conn.select(qry_project)
+        return self._get_conn().select(qry_project)
 
     def list_subjects_all(self, projectcode, fieldnames=None):
         """
-        Lists all subjects in a project to console
+        Lists all subjects in a project to csv file
+        :param projectcode:
+        :param fieldnames: columns from the XNAT subject listing (default label, ID)
+        :return: output filename
         """
-
-        subj = self.get_subjects(projectcode)
+        if fieldnames is None:
+            fieldnames = ['label', 'ID']  # label eg S0001, ID eg XNAT_S00006
+        # One REST listing with the columns required rather than attribute calls per subject
+        qry = '/data/projects/%s/subjects?columns=%s' % (projectcode, ','.join(fieldnames))
+        rows = self._get_conn()._get_json(qry)
         outfilename = projectcode + '_subjectlist.csv'
-        with open(outfilename, 'wb') as csvfile:
-            if fieldnames is None:
-                fieldnames = ['ID', 'group', 'label', 'dob', 'gender', 'handedness', 'education']
-            mywriter = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            mywriter.writeheader()
-            for s in subj:
-                print("ID=", s.label(), ", SubjectID=", s.id())  # xnat subject id eg XNAT_S00006
-                # ID	group	label	dob	gender	handedness	education
-                mywriter.writerow({'ID': s.label(),
-                                   'group': s.attrs.get('group'),
-                                   'dob': s.attrs.get('dob'),
-                                   'gender': s.attrs.get('gender'),
-                                   'handedness': s.attrs.get('handedness'),
-                                   'education': s.attrs.get('education')
-                                   })
+        with open(outfilename, 'w', newline='') as csvfile:
+            mywriter = csv.writer(csvfile)
+            mywriter.writerow(fieldnames)
+            for i, row in enumerate(rows, 1):
+                mywriter.writerow([row.get(f) for f in fieldnames])
+                if i % 1000 == 0:
+                    print("Subjects written:", i)
         print("Subjects written to file:", outfilename)
         return outfilename
 
@@ -121,7 +160,7 @@ class XnatConnector:
         if s.exists():
             return s.id()
         else:
-            logging.warning("Subject not found: %s", label)
+            logger.warning("Subject not found: %s", label)
             return None
 
     def createSubject(self, projectcode, label, subjectkwargs):
@@ -137,7 +176,7 @@ class XnatConnector:
             subject.attrs.mset(subjectkwargs)
             return subject
         else:
-            logging.warning("Subject not created: %s", label)
+            logger.warning("Subject not created: %s", label)
             return None
 
     def createExperiment(self, subject, xsdtype, exptid, mandata, exptdata):
@@ -154,7 +193,7 @@ class XnatConnector:
         if subject is not None:
             mandata['experiments'] = xsdtype
             mandata['ID'] = exptid
-            logging.debug(mandata)
+            logger.debug(mandata)
             if xsdtype + '/date' in mandata:
                 vdate = mandata[xsdtype + '/date']
                 if "-" in vdate:
@@ -179,15 +218,23 @@ class XnatConnector:
         return expt
 
     def checkUniqueLabel(self, subject, label):
+        """
+        Check MR session label is not already used by subject, otherwise increment the counter suffix
+        :param subject: Subject object
+        :param label: label as prefix_counter eg MR_S0001_0
+        :return: unique label
+        """
         prefix = label.rsplit('_', 1)[0]
-        experiments = [e.label() for e in subject.experiments() if
-                       e.datatype() == 'xnat:mrSessionData' and e.label().startswith(prefix)]
+        # One REST listing of MR session labels, filtered by type on the server
+        rows = self._get_conn()._get_json('%s/experiments?xsiType=xnat:mrSessionData&columns=label,xsiType'
+                                          % subject._uri)
+        experiments = set(r['label'] for r in rows if
+                          r['xsiType'] == 'xnat:mrSessionData' and r['label'].startswith(prefix + '_'))
         if label in experiments:
-            experiments.sort(reverse=True)
-            ctr = experiments[0].rsplit('_', 1)[1]
-            # prefix = experiments[0].rsplit('_', 1)[0]
-            c = int(ctr) + 1
-            label = prefix + "_" + str(c)
+            # numeric max as string sort puts _9 after _10
+            ctrs = [e.rsplit('_', 1)[1] for e in experiments]
+            ctr = max([int(c) for c in ctrs if c.isdigit()] or [-1])
+            label = '%s_%d' % (prefix, ctr + 1)
         return label
 
     def updateExptDate(self, subject, exptid, exptdate, dsitype):
@@ -256,7 +303,7 @@ class XnatConnector:
             criteria = [('xnat:subjectData/SUBJECT_ID', 'LIKE', '*'), 'AND']
         if dsitype is None:
             dsitype = 'xnat:subjectData'
-        subj = self.conn.select(dsitype, columns).where(criteria)
+        subj = self._get_conn().select(dsitype, columns).where(criteria)
         # Convert to dataframe
         if len(subj) > 0:
             df_subjects = pd.DataFrame(list(subj))
@@ -267,20 +314,66 @@ class XnatConnector:
             df_subjects = None
         return df_subjects
 
-    def upload_MRIscans(self, projectcode, scandir, opexid=False, proj_pi=None):
+    def _upload_one_subject(self, project, suploader, scandir, slabel, sid, subjectlabel, visitid, donepath):
+        """
+        Upload scans for a single subject directory then move it to donepath
+        :param project: Project object
+        :param suploader: ScanUploader
+        :param scandir: dir containing subject dirs
+        :param slabel: subject directory name
+        :param sid: XNAT subject ID (from project subject listing so known to exist)
+        :param subjectlabel: XNAT subject label
+        :param visitid: visit number
+        :param donepath: dir for uploaded subject dirs
+        :return: number of scans loaded
+        """
+        ctr = 0
+        s = project.subject(sid)
+        uploaddir = join(scandir, slabel, 'scans')
+        elabel = 'MR_%s_%d' % (subjectlabel, ctr)
+        elabel = self.checkUniqueLabel(s, elabel)
+        logger.info("Uploading scans for %s: %s with expt=%s", sid, subjectlabel, elabel)
+        ctr = suploader.subject_uploadscans(s, uploaddir, elabel, visitid)
+        # mark or move folder if done
+        if ctr > 0 and donepath:
+            try:
+                shutil.move(join(scandir, slabel), donepath)
+                logger.info("Uploaded scans moved to %s", donepath)
+            except IOError:
+                logger.warning("Error in moving uploaded scans to %s", donepath)
+        return ctr
+
+    def _upload_subject_dirs(self, project, suploader, scandir, slabels, sid, subjectlabel, visitid, donepath):
+        """
+        Upload subject directories for the same XNAT subject in turn so each gets a unique session label
+        :param slabels: subject directory names
+        (other params as for _upload_one_subject)
+        :return: dict of subject directory name to number of scans loaded
+        """
+        return dict((slabel, self._upload_one_subject(project, suploader, scandir, slabel, sid, subjectlabel,
+                                                      visitid, donepath))
+                    for slabel in slabels)
+
+    def upload_MRIscans(self, projectcode, scandir, opexid=False, proj_pi=None, max_workers=None, force=False):
         """
         Upload MRI scans from scandir to project
+        Uploaded subject dirs are moved to done/projectcode/scandir_name (next to scandir) with upload_state.json
         :param projectcode: XNAT ID for project eg QBICC
         :param scandir: full path name of dir containing subdirs with data
         eg /ibscratch/irc5scans/data
         data should be organized by DICOM series as: data/subject_label/scans/series_number/*.dcm (or *.IMA)
-        :return: number of sessions loaded
+        :param max_workers: number of subjects uploaded concurrently (default 2 x cpus up to MAX_UPLOAD_WORKERS).
+        Connections above MAX_UPLOAD_WORKERS are not kept alive
+        :param force: upload subjects even if already recorded as uploaded
+        :return: number of scans loaded
         """
 
         project = self.get_project(projectcode)
         suploader = ScanUploader(proj_pi)
         ctr = 0
-        scanfiles = [f for f in listdir(scandir) if os.path.isdir(join(scandir, f))]
+        scandir = os.path.normpath(scandir)
+        with os.scandir(scandir) as it:
+            scanfiles = [e.name for e in it if e.is_dir(follow_symlinks=False)]
         if len(scanfiles) > 0:
             dirpath = os.path.dirname(scandir)
             # opex
@@ -290,51 +383,86 @@ class XnatConnector:
                 visitid = int(m.group(1))
             else:
                 visitid = 1
-            donepath = join(dirpath, 'done')
-            if not os.path.isdir(donepath):
-                try:
-                    os.mkdir(donepath)
-                except:
-                    raise OSError
+            # separate done dir per project and visit so same subject dirs in other uploads aren't skipped
+            donepath = join(dirpath, 'done', projectcode, os.path.basename(scandir))
+            os.makedirs(donepath, exist_ok=True)
         else:
-            message = "No scans found: %s" % scandir
-            logging.error(message)
+            logger.error("No scans found: %s", scandir)
+            return ctr
 
-        # Loop through each directory where directory name is subject id
+        # Skip subjects already uploaded before any DICOM reads or REST calls
+        statefile = join(donepath, UPLOAD_STATE_FILE)
+        upload_state = self._load_upload_state(statefile)
+        pending = []
         for slabel in scanfiles:
+            if not force and (slabel in upload_state or os.path.exists(join(donepath, slabel))):
+                logger.info("Subject already uploaded - skipping %s", slabel)
+            else:
+                pending.append(slabel)
+        if len(pending) == 0:
+            return ctr
+
+        # Single listing of project subjects rather than a lookup per directory
+        rows = self._get_conn()._get_json('/data/projects/%s/subjects?columns=ID,label' % projectcode)
+        label_to_id = dict((r['label'], r['ID']) for r in rows)
+        if max_workers is None:
+            max_workers = min(MAX_UPLOAD_WORKERS, (os.cpu_count() or 1) * 2)
+        # Group directories by subject (opexid dirs eg 1006JJ06, 1006JJ12 share one subject)
+        subjectdirs = OrderedDict()
+        # Loop through each directory where directory name is subject id
+        for slabel in pending:
             if opexid and len(slabel) > 6:
                 # try to extract slabel eg 1006JJ06
-                sid = self.get_subjectid_bylabel(projectcode, slabel[0:6])
+                subjectlabel = slabel[0:6]
             else:
-                sid = self.get_subjectid_bylabel(projectcode, slabel)
+                subjectlabel = slabel
+            sid = label_to_id.get(subjectlabel)
             if sid is None:
-                logging.warning("Subject doesn't exist - skipping %s", slabel)
+                logger.warning("Subject doesn't exist - skipping %s", slabel)
                 continue
-
-            s = project.subject(sid)
-            uploaddir = join(scandir, slabel, 'scans')
-            if s.exists():
-                elabel = 'MR_%s_%d' % (s.label(), ctr)
-                elabel = self.checkUniqueLabel(s, elabel)
-                message = "Uploading scans for %s: %s with expt=%s" % (s.id(), s.label(), elabel)
-                logging.info(message)
-                print(message)
-                ctr = ctr + suploader.subject_uploadscans(s, uploaddir, elabel, visitid)
-                # mark or move folder if done
-                if ctr > 0 and donepath:
-                    try:
-                        shutil.move(join(scandir, slabel), donepath)
-                        message = "Uploaded scans moved to %s" % donepath
-                        logging.info(message)
-                        print(message)
-                    except IOError:
-                        message = "Error in moving uploaded scans to %s" % donepath
-                        logging.warning(message)
-                        print(message)
-            else:
-                logging.warning("Subject doesn't exist in this project: %s %s", projectcode, sid)
+            subjectdirs.setdefault((sid, subjectlabel), []).append(slabel)
+        # Uploads are network bound so run subjects in threads sharing the connection
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._upload_subject_dirs, project, suploader, scandir, slabels, sid,
+                                       subjectlabel, visitid, donepath)
+                       for (sid, subjectlabel), slabels in subjectdirs.items()]
+            try:
+                for future in as_completed(futures):
+                    for slabel, scans in future.result().items():
+                        if scans > 0:
+                            upload_state[slabel] = datetime.datetime.now().isoformat()
+                        ctr = ctr + scans
+            finally:
+                self._save_upload_state(statefile, upload_state)
         return ctr
 
+    def _load_upload_state(self, statefile):
+        """
+        Load record of uploaded subjects
+        :param statefile: json file
+        :return: dict of subject directory name to upload timestamp
+        """
+        if not os.path.isfile(statefile):
+            return {}
+        try:
+            with open(statefile) as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Unable to read upload state - ignoring: %s", statefile)
+            return {}
+
+    def _save_upload_state(self, statefile, upload_state):
+        """
+        Save record of uploaded subjects
+        :param statefile: json file
+        :param upload_state: dict of subject directory name to upload timestamp
+        """
+        try:
+            with open(statefile, 'w') as f:
+                json.dump(upload_state, f, indent=2, sort_keys=True)
+        except IOError:
+            logger.warning("Unable to save upload state: %s", statefile)
+
     def delete_subjects_all(self, projectcode):
         """
         Removes all subjects from a project
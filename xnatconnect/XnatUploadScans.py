@@ -9,16 +9,21 @@ DICOM FILE FORMATS: dcm or Siemens IMA
 
 @author: Liz Cooper-Williams, QBI
 """
-import glob
 import logging
+import os
 import warnings
-from os import listdir
 from os.path import join
 from datetime import datetime
 
 import pydicom as dicom
+from pydicom.dataset import Dataset
 
 warnings.filterwarnings("ignore")
+logger = logging.getLogger(__name__)
+
+# Only header fields used by ScanUploader
+DICOM_HEADER_TAGS = ['SOPClassUID', 'Modality', 'SeriesNumber', 'SeriesDate', 'SeriesTime',
+                     'RequestedProcedureDescription']
 
 
 class ScanUploader:
@@ -43,45 +48,48 @@ class ScanUploader:
         scan_ctr = 0
         # (scan_date, scan_time) = (None, None)
         others = {}
-        for subdr in listdir(uploaddir):
+        with os.scandir(uploaddir) as it:
+            seriesdirs = [e.name for e in it if e.is_dir(follow_symlinks=False)]
+        for subdr in seriesdirs:
             dcm_path = join(uploaddir, subdr)
-            scan_files = glob.glob(join(dcm_path, '*.*'))
-            if len(scan_files) == 0:  # check this isn't wrong dir
-                logging.warning("File directory doesn't contain dcm files:%s", uploaddir)
+            scan_file = self._first_dicom_file(dcm_path)
+            if scan_file is None:  # check this isn't wrong dir
+                logger.warning("File directory doesn't contain dcm files:%s", uploaddir)
                 continue
 
-            scan_type = self.getScanType(self.default_scantype, scan_files[0])
-            scan_id = self.getSeriesNumber(subdr, scan_files[0])
-            print('Scan ID: %s  Scan type=%s' % (scan_id, scan_type))
+            # Parse header once and reuse for all fields
+            dcm = self._read_dicom_header(scan_file)
+            scan_type = self.getScanType(self.default_scantype, dcm)
+            scan_id = self.getSeriesNumber(subdr, dcm)
+            logger.info('Scan ID: %s  Scan type=%s', scan_id, scan_type)
 
-            scan_pi = self.getPI(scan_files[0])
+            scan_pi = self.getPI(dcm)
             if self.proj_pi is not None:
                 if self.proj_pi in scan_pi:
-                    message = "Owner verified:  scan=%s project=%s" % (scan_pi, self.proj_pi)
-                    logging.info(message)
+                    logger.info("Owner verified:  scan=%s project=%s", scan_pi, self.proj_pi)
                 else:
-                    message = "Owner does not match - skipping upload: scan=%s project=" % (scan_pi, self.proj_pi)
-                    logging.warning(message)
+                    logger.warning("Owner does not match - skipping upload: scan=%s project=%s", scan_pi,
+                                   self.proj_pi)
                     continue
-            # (scan_date, scan_time) = self.getSeriesDatestamp(scan_files[0])
+            # (scan_date, scan_time) = self.getSeriesDatestamp(dcm)
 
             scan = expt.scan(str(scan_id))
             # scan.insert() #Should detect type BUT IT DOESN'T
             if scan_type == 'MR Image Storage' or '1.2.840.10008.5.1.4.1.1.4' in scan_type:
                 scan.create(scans='xnat:mrScanData')
                 scan_ctr += 1
-                logging.info("Scan created[%s]:  MR Image Storage [%s] - %s", scan_id, scan_type, scan_pi)
+                logger.info("Scan created[%s]:  MR Image Storage [%s] - %s", scan_id, scan_type, scan_pi)
             elif scan_type == 'Secondary Capture Image Storage' or '1.2.840.10008.5.1.4.1.1.7' in scan_type:
                 scan.create(scans='xnat:scScanData')
                 scan_ctr += 1
-                logging.info("Scan created[%s]:  Secondary Capture Image Storage [%s] - %s", scan_id, scan_type,
-                             scan_pi)
+                logger.info("Scan created[%s]:  Secondary Capture Image Storage [%s] - %s", scan_id, scan_type,
+                            scan_pi)
             else:
-                modality = self.getModality(scan_files[0])
+                modality = self.getModality(dcm)
                 if modality is not None and modality == 'MR':
                     scan.create(scans='xnat:otherDicomScanData')
                     scan_ctr += 1
-                    logging.info("Scan created[%s]:  Other DICOM [%s] - %s", scan_id, scan_type, scan_pi)
+                    logger.info("Scan created[%s]:  Other DICOM [%s] - %s", scan_id, scan_type, scan_pi)
 
             dicom_resource = scan.resource('DICOM')  # crucial for display DICOM headers
             dicom_resource.put_dir(dcm_path, overwrite=True, extract=True)
@@ -95,14 +103,32 @@ class ScanUploader:
                 expt.trigger_pipelines()
 
             except:
-                message = "Unable to extract header data from this xsi type: %s" % scan_type
-                logging.warning(message)
+                logger.warning("Unable to extract header data from this xsi type: %s", scan_type)
 
         return scan_ctr
 
+    def _first_dicom_file(self, dcm_path):
+        """
+        Find first file in series directory (as for glob *.*) without listing the whole directory
+        :param dcm_path: series directory
+        :return: full path of file or None
+        """
+        with os.scandir(dcm_path) as it:
+            return next((e.path for e in it if '.' in e.name and not e.name.startswith('.') and e.is_file()), None)
+
+    def _read_dicom_header(self, dicomfile):
+        """
+        Read required DICOM header fields only (pixel data and other tags skipped)
+        :param dicomfile: filename or an already parsed dataset
+        :return: pydicom Dataset
+        """
+        if isinstance(dicomfile, Dataset):
+            return dicomfile
+        return dicom.dcmread(dicomfile, stop_before_pixels=True, specific_tags=DICOM_HEADER_TAGS)
+
     def getScanType(self, dirlabel, dicomfile):
         type = dirlabel
-        dcm = dicom.read_file(dicomfile)
+        dcm = self._read_dicom_header(dicomfile)
         if dcm:
             type = dcm.SOPClassUID
 
@@ -110,7 +136,7 @@ class ScanUploader:
 
     def getModality(self, dicomfile):
         type = None
-        dcm = dicom.read_file(dicomfile)
+        dcm = self._read_dicom_header(dicomfile)
         if dcm:
             type = dcm.Modality
 
@@ -118,7 +144,7 @@ class ScanUploader:
 
     def getSeriesNumber(self, dirlabel, dicomfile):
         series = dirlabel
-        dcm = dicom.read_file(dicomfile)
+        dcm = self._read_dicom_header(dicomfile)
         if dcm:
             series = dcm.SeriesNumber
 
@@ -127,11 +153,11 @@ class ScanUploader:
     def getSeriesDatestamp(self, dicomfile):
         """
         Get date and time from dicom
-        :param dicomfile:
+        :param dicomfile: filename or parsed dataset
         :return: datetime object
         """
         do = None
-        dcm = dicom.read_file(dicomfile)
+        dcm = self._read_dicom_header(dicomfile)
         if dcm:
             sdate = dcm.SeriesDate
             stime = dcm.SeriesTime
@@ -140,7 +166,7 @@ class ScanUploader:
 
     def getPI(self, dicomfile):
         pi = None
-        dcm = dicom.read_file(dicomfile)
+        dcm = self._read_dicom_header(dicomfile)
         if dcm:
             pi = dcm.RequestedProcedureDescription  # check this field is set with Principal Investigator
         return pi